@@ -23,8 +23,13 @@
 
 # COMMAND ----------
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import atexit
 import json
+import os
+import threading
+import time
 
 # Master ETL configuration
 ETL_RUN_ID = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -33,13 +38,31 @@ LAST_SUCCESSFUL_RUN = "2025-01-01 00:00:00"  # Update with last successful times
 
 # Notebook execution configuration
 NOTEBOOK_TIMEOUT_SECONDS = 3600  # 1 hour per notebook
-PARALLEL_EXECUTION = False  # Set to True to run independent notebooks in parallel
+PARALLEL_EXECUTION = False  # Set to True to run notebooks as soon as their dependencies finish
+MAX_NB_CONCURRENCY = int(os.environ.get("MAX_NB_CONCURRENCY", "4"))  # Notebooks running at once
+NOTEBOOK_RUN_ATTEMPTS = 3  # Attempts per notebook on transient (429 / unavailable) errors
+
+# In-flight embedding requests per Spark task in entity notebooks. Embedding is
+# network-bound, so this raises request concurrency without adding Spark tasks
+# that would also multiply Neo4j writers
+EMBEDDING_CONCURRENCY = os.environ.get("SPARK_EMBED_CONCURRENCY", "8")
+
+# Per-notebook results are written here as each notebook finishes
+ETL_RUN_LOG_DIR = "abfss://etl@arthurhealth.dfs.core.windows.net/etl_runs"  # Replace with your ADLS path
+ETL_RUN_LOG_PATH = f"{ETL_RUN_LOG_DIR}/{ETL_RUN_ID}.jsonl"
+
+try:
+    dbutils.fs.mkdirs(ETL_RUN_LOG_DIR)
+except Exception as e:
+    print(f"⚠️  Failed to create run log directory {ETL_RUN_LOG_DIR}: {str(e)}")
 
 print(f"🚀 Master ETL Orchestration Started")
 print(f"   Run ID: {ETL_RUN_ID}")
 print(f"   Mode: {'Incremental' if INCREMENTAL_MODE else 'Full Refresh'}")
 print(f"   Last Successful Run: {LAST_SUCCESSFUL_RUN}")
-print(f"   Parallel Execution: {PARALLEL_EXECUTION}")
+print(f"   Parallel Execution: {PARALLEL_EXECUTION} (max {MAX_NB_CONCURRENCY} notebooks)")
+print(f"   Embedding Concurrency: {EMBEDDING_CONCURRENCY}")
+print(f"   Run Log: {ETL_RUN_LOG_PATH}")
 
 # COMMAND ----------
 
@@ -48,90 +71,117 @@ print(f"   Parallel Execution: {PARALLEL_EXECUTION}")
 
 # COMMAND ----------
 
-# Define ETL pipeline stages with dependencies
-etl_pipeline = {
-    "stage_1_entities": {
-        "description": "Load entity nodes (can run in parallel)",
-        "parallel": True,
-        "notebooks": [
-            {
-                "path": "/arthur-health/01_patients_etl",
-                "name": "patients",
-                "timeout": 3600,
-                "parameters": {
-                    "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
-                    "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN
-                }
-            },
-            {
-                "path": "/arthur-health/02_medications_etl",
-                "name": "medications",
-                "timeout": 3600,
-                "parameters": {
-                    "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
-                    "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN
-                }
-            },
-            # Add more entity notebooks here as they are created
-            # {
-            #     "path": "/arthur-health/03_providers_etl",
-            #     "name": "providers",
-            #     "timeout": 3600,
-            #     "parameters": {...}
-            # },
-            # {
-            #     "path": "/arthur-health/04_diagnoses_etl",
-            #     "name": "diagnoses",
-            #     "timeout": 3600,
-            #     "parameters": {...}
-            # },
-        ]
+# Define the ETL pipeline as a DAG: each notebook lists the notebooks it depends on
+# and starts as soon as all of them have succeeded. "stage" only groups results.
+etl_pipeline = [
+    # Stage 1: entity nodes
+    {
+        "name": "patients",
+        "stage": "stage_1_entities",
+        "path": "/arthur-health/01_patients_etl",
+        "timeout": 3600,
+        "parameters": {
+            "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
+            "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN,
+            "EMBEDDING_CONCURRENCY": EMBEDDING_CONCURRENCY
+        },
+        "depends_on": []
     },
-    "stage_2_relationships": {
-        "description": "Create relationships between entities (requires stage 1 complete)",
-        "parallel": True,
-        "notebooks": [
-            {
-                "path": "/arthur-health/03_patient_medication_relationships",
-                "name": "patient_medication_relationships",
-                "timeout": 3600,
-                "parameters": {
-                    "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
-                    "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN
-                }
-            },
-            # Add more relationship notebooks here
-            # {
-            #     "path": "/arthur-health/patient_diagnosis_relationships",
-            #     "name": "patient_diagnosis_relationships",
-            #     "timeout": 3600,
-            #     "parameters": {...}
-            # },
-        ]
+    {
+        "name": "medications",
+        "stage": "stage_1_entities",
+        "path": "/arthur-health/02_medications_etl",
+        "timeout": 3600,
+        "parameters": {
+            "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
+            "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN,
+            "EMBEDDING_CONCURRENCY": EMBEDDING_CONCURRENCY
+        },
+        "depends_on": []
     },
-    "stage_3_validation": {
-        "description": "Data quality validation and gap detection",
-        "parallel": False,
-        "notebooks": [
-            # Add validation notebooks here
-            # {
-            #     "path": "/arthur-health/data_quality_validation",
-            #     "name": "data_quality",
-            #     "timeout": 1800,
-            #     "parameters": {}
-            # }
-        ]
-    }
-}
+    # Add more entity notebooks here as they are created
+    # {
+    #     "name": "providers",
+    #     "stage": "stage_1_entities",
+    #     "path": "/arthur-health/03_providers_etl",
+    #     "timeout": 3600,
+    #     "parameters": {...},
+    #     "depends_on": []
+    # },
+
+    # Stage 2: relationships (need both endpoint node types loaded)
+    {
+        "name": "patient_medication_relationships",
+        "stage": "stage_2_relationships",
+        "path": "/arthur-health/03_patient_medication_relationships",
+        "timeout": 3600,
+        "parameters": {
+            "INCREMENTAL_MODE": str(INCREMENTAL_MODE),
+            "LAST_RUN_TIMESTAMP": LAST_SUCCESSFUL_RUN
+        },
+        "depends_on": ["patients", "medications"]
+    },
+    # Add more relationship notebooks here
+    # {
+    #     "name": "patient_diagnosis_relationships",
+    #     "stage": "stage_2_relationships",
+    #     "path": "/arthur-health/patient_diagnosis_relationships",
+    #     "timeout": 3600,
+    #     "parameters": {...},
+    #     "depends_on": ["patients", "diagnoses"]
+    # },
+
+    # Stage 3: data quality validation and gap detection
+    # {
+    #     "name": "data_quality",
+    #     "stage": "stage_3_validation",
+    #     "path": "/arthur-health/data_quality_validation",
+    #     "timeout": 1800,
+    #     "parameters": {},
+    #     "depends_on": ["patient_medication_relationships"]
+    # },
+]
+
+def validate_pipeline(pipeline):
+    """
+    Check that every dependency exists and the dependency graph has no cycles
+    Raises: ValueError describing the first problem found
+    """
+    names = {nb["name"] for nb in pipeline}
+    for nb in pipeline:
+        unknown = set(nb["depends_on"]) - names
+        if unknown:
+            raise ValueError(f"Notebook {nb['name']} depends on unknown notebooks: {sorted(unknown)}")
+
+    remaining = {nb["name"]: set(nb["depends_on"]) for nb in pipeline}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Dependency cycle between notebooks: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+validate_pipeline(etl_pipeline)
+
+# Keep the DAG next to the run log so each run records what it executed
+try:
+    dbutils.fs.put(
+        f"{ETL_RUN_LOG_DIR}/{ETL_RUN_ID}_dag.json",
+        json.dumps(
+            [{k: nb[k] for k in ("name", "stage", "path", "depends_on")} for nb in etl_pipeline],
+            indent=2
+        ),
+        overwrite=True
+    )
+except Exception as e:
+    print(f"⚠️  Failed to write pipeline DAG: {str(e)}")
 
 print("📋 ETL Pipeline Configuration:")
-for stage_name, stage_config in etl_pipeline.items():
-    print(f"\n{stage_name}:")
-    print(f"   Description: {stage_config['description']}")
-    print(f"   Parallel: {stage_config['parallel']}")
-    print(f"   Notebooks: {len(stage_config['notebooks'])}")
-    for nb in stage_config['notebooks']:
-        print(f"      - {nb['name']}")
+for nb in etl_pipeline:
+    depends_on = ", ".join(nb["depends_on"]) or "none"
+    print(f"   - {nb['name']} ({nb['stage']}) depends on: {depends_on}")
 
 # COMMAND ----------
 
@@ -140,6 +190,39 @@ for stage_name, stage_config in etl_pipeline.items():
 
 # COMMAND ----------
 
+# One bounded pool for the whole run: each running notebook holds a job slot, so
+# concurrency is capped rather than growing with the number of ready notebooks.
+# Each dbutils.notebook.run call blocks its thread until the child finishes, so a
+# dedicated pool (not Spark's scheduler) overlaps the waits
+notebook_pool = ThreadPoolExecutor(
+    max_workers=MAX_NB_CONCURRENCY if PARALLEL_EXECUTION else 1,
+    thread_name_prefix="nb-run"
+)
+atexit.register(notebook_pool.shutdown, wait=True)
+
+TRANSIENT_ERROR_MARKERS = ("429", "TEMPORARILY_UNAVAILABLE")
+
+def run_notebook_with_retry(notebook_path, parameters, timeout):
+    """
+    Run a notebook, retrying with exponential backoff on transient errors
+    Returns: the notebook's exit value
+    """
+    for attempt in range(NOTEBOOK_RUN_ATTEMPTS):
+        try:
+            return dbutils.notebook.run(
+                notebook_path,
+                timeout_seconds=timeout,
+                arguments=parameters
+            )
+        except Exception as e:
+            transient = any(marker in str(e) for marker in TRANSIENT_ERROR_MARKERS)
+            if not transient or attempt == NOTEBOOK_RUN_ATTEMPTS - 1:
+                raise
+
+            delay = 2 ** attempt
+            print(f"⚠️  Transient error running {notebook_path}, retrying in {delay}s: {str(e)}")
+            time.sleep(delay)
+
 def run_notebook_with_logging(notebook_path, notebook_name, parameters, timeout):
     """
     Execute a notebook and log results
@@ -153,11 +236,7 @@ def run_notebook_with_logging(notebook_path, notebook_name, parameters, timeout)
         print(f"   Parameters: {parameters}")
 
         # Execute notebook using dbutils
-        result = dbutils.notebook.run(
-            notebook_path,
-            timeout_seconds=timeout,
-            arguments=parameters
-        )
+        result = run_notebook_with_retry(notebook_path, parameters, timeout)
 
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
@@ -175,71 +254,130 @@ def run_notebook_with_logging(notebook_path, notebook_name, parameters, timeout)
 
         return False, {"result": None, "error": str(e)}, duration
 
-def run_stage(stage_name, stage_config):
+run_log_lock = threading.Lock()
+run_log_lines = []
+
+def log_notebook_result(notebook_name, success, result, duration, skipped=False):
     """
-    Execute all notebooks in a stage
-    Returns: (success: bool, results: list)
+    Append one notebook's outcome to the run log as a JSON line
+    The log is rewritten through dbutils.fs after every notebook, so it
+    survives a driver crash with everything that finished before it
+    """
+    record = {
+        "run_id": ETL_RUN_ID,
+        "notebook": notebook_name,
+        "success": success,
+        "skipped": skipped,
+        "duration": duration,
+        "result": result["result"],
+        "error": result["error"],
+        "logged_at": datetime.now().isoformat()
+    }
+
+    try:
+        with run_log_lock:
+            run_log_lines.append(json.dumps(record))
+            dbutils.fs.put(ETL_RUN_LOG_PATH, "\n".join(run_log_lines) + "\n", overwrite=True)
+    except Exception as e:
+        print(f"⚠️  Failed to write run log for {notebook_name}: {str(e)}")
+
+def run_stage_notebook(notebook):
+    """
+    Execute a single notebook entry from the pipeline definition
+    Returns: dict with notebook name, stage, success flag, duration and error
     """
-    print(f"\n{'='*60}")
-    print(f"STAGE: {stage_name}")
-    print(f"{stage_config['description']}")
-    print(f"{'='*60}")
+    success, result, duration = run_notebook_with_logging(
+        notebook['path'],
+        notebook['name'],
+        notebook['parameters'],
+        notebook['timeout']
+    )
+
+    log_notebook_result(notebook['name'], success, result, duration)
+
+    return {
+        "notebook": notebook['name'],
+        "stage": notebook['stage'],
+        "success": success,
+        "skipped": False,
+        "duration": duration,
+        "error": result["error"]
+    }
 
+def skip_downstream(failed_name, remaining, notebooks):
+    """
+    Remove every notebook that depends (directly or transitively) on a failed one
+    Returns: list of skipped notebook results
+    """
+    blocked = {failed_name}
+    skipped = []
+    changed = True
+
+    while changed:
+        changed = False
+        for name in list(remaining):
+            if remaining[name] & blocked:
+                del remaining[name]
+                blocked.add(name)
+                changed = True
+                print(f"⏭️  Skipping: {name} (upstream {failed_name} failed)")
+                error = f"Skipped: upstream notebook {failed_name} failed"
+                log_notebook_result(name, False, {"result": None, "error": error}, 0.0, skipped=True)
+                skipped.append({
+                    "notebook": name,
+                    "stage": notebooks[name]['stage'],
+                    "success": False,
+                    "skipped": True,
+                    "duration": 0.0,
+                    "error": error
+                })
+
+    return skipped
+
+def run_pipeline(pipeline, executor):
+    """
+    Execute the pipeline DAG on executor, starting each notebook as soon as all of
+    its dependencies have succeeded; dependents of a failed notebook are skipped
+    Returns: (success: bool, results: list)
+    """
+    notebooks = {nb['name']: nb for nb in pipeline}
+    remaining = {nb['name']: set(nb['depends_on']) for nb in pipeline}
     results = []
-    all_success = True
-
-    # Run notebooks
-    if stage_config['parallel'] and PARALLEL_EXECUTION:
-        print("⚡ Executing notebooks in parallel...")
-        # Note: Spark notebook parallel execution requires threading
-        # For simplicity, we'll run sequentially for now
-        # In production, use ThreadPoolExecutor or Synapse Pipelines
-        for notebook in stage_config['notebooks']:
-            success, result, duration = run_notebook_with_logging(
-                notebook['path'],
-                notebook['name'],
-                notebook['parameters'],
-                notebook['timeout']
-            )
+    running = {}
 
-            results.append({
-                "notebook": notebook['name'],
-                "success": success,
-                "duration": duration,
-                "result": result
-            })
-
-            if not success:
-                all_success = False
-                # For critical stages, stop on first failure
-                if stage_name == "stage_1_entities":
-                    print(f"⚠️  Critical stage failed, stopping execution")
-                    break
+    if PARALLEL_EXECUTION:
+        print("⚡ Executing notebooks in parallel as dependencies complete...")
     else:
-        print("📝 Executing notebooks sequentially...")
-        for notebook in stage_config['notebooks']:
-            success, result, duration = run_notebook_with_logging(
-                notebook['path'],
-                notebook['name'],
-                notebook['parameters'],
-                notebook['timeout']
-            )
-
-            results.append({
-                "notebook": notebook['name'],
-                "success": success,
-                "duration": duration,
-                "result": result
-            })
+        print("📝 Executing notebooks sequentially in dependency order...")
 
-            if not success:
-                all_success = False
-                # For critical stages, stop on first failure
-                if stage_name == "stage_1_entities":
-                    print(f"⚠️  Critical stage failed, stopping execution")
-                    break
+    def submit_ready():
+        for name in [name for name, deps in remaining.items() if not deps]:
+            del remaining[name]
+            running[executor.submit(run_stage_notebook, notebooks[name])] = name
 
-    return all_success, results
+    try:
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                notebook_result = future.result()
+                results.append(notebook_result)
+
+                if notebook_result["success"]:
+                    for deps in remaining.values():
+                        deps.discard(name)
+                else:
+                    results.extend(skip_downstream(name, remaining, notebooks))
+
+            submit_ready()
+    finally:
+        # Cancel notebooks that have not started yet; running ones cannot be
+        # interrupted and finish in the background
+        for future in running:
+            future.cancel()
+
+    return all(r["success"] for r in results), results
 
 # COMMAND ----------
 
@@ -249,22 +387,17 @@ def run_stage(stage_name, stage_config):
 # COMMAND ----------
 
 pipeline_start_time = datetime.now()
-pipeline_results = {}
-pipeline_success = True
-
-# Execute each stage in order
-for stage_name, stage_config in etl_pipeline.items():
-    stage_success, stage_results = run_stage(stage_name, stage_config)
 
-    pipeline_results[stage_name] = {
-        "success": stage_success,
-        "results": stage_results
-    }
+pipeline_success, notebook_results = run_pipeline(etl_pipeline, notebook_pool)
 
-    if not stage_success:
-        pipeline_success = False
-        print(f"\n⚠️  Stage {stage_name} failed, stopping pipeline execution")
-        break
+# Group notebook results by stage for reporting, in pipeline definition order
+pipeline_results = {}
+for nb in etl_pipeline:
+    pipeline_results.setdefault(nb['stage'], {"success": True, "results": []})
+for notebook_result in notebook_results:
+    stage_results = pipeline_results[notebook_result["stage"]]
+    stage_results["results"].append(notebook_result)
+    stage_results["success"] = stage_results["success"] and notebook_result["success"]
 
 pipeline_end_time = datetime.now()
 pipeline_duration = (pipeline_end_time - pipeline_start_time).total_seconds()
@@ -292,11 +425,15 @@ for stage_name, stage_data in pipeline_results.items():
     print(f"\n{stage_status} {stage_name}:")
 
     for notebook_result in stage_data["results"]:
+        if notebook_result["skipped"]:
+            print(f"   ⏭️  {notebook_result['notebook']}: {notebook_result['error']}")
+            continue
+
         nb_status = "✅" if notebook_result["success"] else "❌"
         print(f"   {nb_status} {notebook_result['notebook']}: {notebook_result['duration']:.2f}s")
 
         if not notebook_result["success"]:
-            print(f"      Error: {notebook_result['result']['error']}")
+            print(f"      Error: {notebook_result['error']}")
 
 # COMMAND ----------
 
@@ -306,6 +443,26 @@ for stage_name, stage_data in pipeline_results.items():
 # COMMAND ----------
 
 # Build detailed metadata
+# Tally stage and notebook outcomes in a single pass
+# Skipped notebooks never ran, so they count as skipped rather than executed or failed,
+# and a stage whose notebooks were all skipped was not executed
+stages_executed = stages_succeeded = 0
+notebooks_executed = notebooks_succeeded = notebooks_skipped = 0
+
+for stage_data in pipeline_results.values():
+    stage_ran = False
+    for notebook_result in stage_data["results"]:
+        if notebook_result["skipped"]:
+            notebooks_skipped += 1
+            continue
+        stage_ran = True
+        notebooks_executed += 1
+        notebooks_succeeded += int(notebook_result["success"])
+
+    if stage_ran:
+        stages_executed += 1
+        stages_succeeded += int(stage_data["success"])
+
 etl_metadata = {
     "run_id": ETL_RUN_ID,
     "pipeline_name": "arthur_health_master_etl",
@@ -315,17 +472,18 @@ etl_metadata = {
     "status": "success" if pipeline_success else "failed",
     "incremental_mode": INCREMENTAL_MODE,
     "last_successful_run": LAST_SUCCESSFUL_RUN,
-    "stages_executed": len(pipeline_results),
-    "stages_succeeded": sum(1 for s in pipeline_results.values() if s["success"]),
-    "stages_failed": sum(1 for s in pipeline_results.values() if not s["success"]),
-    "notebooks_executed": sum(len(s["results"]) for s in pipeline_results.values()),
-    "notebooks_succeeded": sum(sum(1 for nb in s["results"] if nb["success"]) for s in pipeline_results.values()),
-    "notebooks_failed": sum(sum(1 for nb in s["results"] if not nb["success"]) for s in pipeline_results.values()),
-    "detailed_results": pipeline_results
+    "stages_executed": stages_executed,
+    "stages_succeeded": stages_succeeded,
+    "stages_failed": stages_executed - stages_succeeded,
+    "notebooks_executed": notebooks_executed,
+    "notebooks_succeeded": notebooks_succeeded,
+    "notebooks_failed": notebooks_executed - notebooks_succeeded,
+    "notebooks_skipped": notebooks_skipped,
+    "run_log_path": ETL_RUN_LOG_PATH
 }
 
 print("\n📝 ETL Metadata:")
-print(json.dumps({k: v for k, v in etl_metadata.items() if k != "detailed_results"}, indent=2))
+print(json.dumps(etl_metadata, indent=2))
 
 # COMMAND ----------
 
@@ -351,7 +509,7 @@ try:
         "notebooks_executed": etl_metadata["notebooks_executed"],
         "notebooks_succeeded": etl_metadata["notebooks_succeeded"],
         "notebooks_failed": etl_metadata["notebooks_failed"],
-        "metadata_json": json.dumps(etl_metadata["detailed_results"])
+        "metadata_json": json.dumps(etl_metadata)
     }])
 
     # Write to Synapse logging table (create table if it doesn't exist)
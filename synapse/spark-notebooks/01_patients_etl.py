@@ -26,12 +26,22 @@
 
 # COMMAND ----------
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
+from pyspark.sql.functions import pandas_udf
+from pyspark.sql.utils import AnalysisException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 import requests
 import json
-from datetime import datetime
+import math
+import re
+from datetime import datetime, timezone
 
 # Neo4j connection configuration
 NEO4J_URI = "neo4j+s://xxxxxxxx.databases.neo4j.io"  # Replace with your AuraDB URI
@@ -51,10 +61,29 @@ SYNAPSE_DATABASE = "healthcare_fhir"
 SYNAPSE_USER = dbutils.secrets.get(scope="arthur-health", key="synapse-user")
 SYNAPSE_PASSWORD = dbutils.secrets.get(scope="arthur-health", key="synapse-password")
 
-# ETL configuration
-INCREMENTAL_MODE = True  # Set to False for full refresh
-LAST_RUN_TIMESTAMP = "2025-01-01 00:00:00"  # Update with last successful run time
-BATCH_SIZE = 1000  # For embedding generation
+# Synapse Parquet staging for full-refresh extracts (external data source and file
+# format must already exist in the SQL pool and point at SYNAPSE_STAGING_PATH)
+SYNAPSE_STAGING_PATH = "abfss://staging@arthurhealth.dfs.core.windows.net"  # Replace with your ADLS path
+SYNAPSE_STAGING_DATA_SOURCE = "arthur_health_staging"
+SYNAPSE_STAGING_FILE_FORMAT = "parquet_file_format"
+
+# ETL configuration (widgets are set by the master orchestrator; defaults apply to manual runs)
+dbutils.widgets.text("INCREMENTAL_MODE", "True")  # Set to False for full refresh
+dbutils.widgets.text("LAST_RUN_TIMESTAMP", "2025-01-01 00:00:00")  # Last successful run time
+INCREMENTAL_MODE = dbutils.widgets.get("INCREMENTAL_MODE") == "True"
+LAST_RUN_TIMESTAMP = dbutils.widgets.get("LAST_RUN_TIMESTAMP")
+JDBC_NUM_PARTITIONS = 32  # Max parallel JDBC connections for the Synapse extract
+JDBC_ROWS_PER_PARTITION = 50000  # Target rows per JDBC partition for small deltas
+NEO4J_WRITE_PARTITIONS = 8  # Concurrent Neo4j writer transactions (keep within AuraDB limits)
+BATCH_SIZE = 256  # Texts per Azure OpenAI embeddings request (API max 2048)
+MAX_CHARS_PER_REQUEST = 300000  # Characters per embeddings request (~75k tokens, under the per-request token cap)
+# In-flight embedding requests per Spark task (set by the master orchestrator)
+dbutils.widgets.text("EMBEDDING_CONCURRENCY", "8")
+EMBEDDING_CONCURRENCY = int(dbutils.widgets.get("EMBEDDING_CONCURRENCY"))
+EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-small
+EMBEDDING_CACHE_PATH = "abfss://etl@arthurhealth.dfs.core.windows.net/embedding_cache"  # Replace with your ADLS path
+QUANTIZE_EMBEDDINGS = True  # Store embeddings in Neo4j as int8 values plus a per-vector scale
+DEBUG = False  # Set to True to print schemas and sample rows (each is an extra Spark job)
 
 print("✅ Configuration loaded")
 
@@ -68,99 +97,190 @@ print("✅ Configuration loaded")
 # Build JDBC URL
 jdbc_url = f"jdbc:sqlserver://{SYNAPSE_SERVER}:1433;database={SYNAPSE_DATABASE};encrypt=true;trustServerCertificate=false;hostNameInCertificate=*.sql.azuresynapse.net;loginTimeout=30;"
 
-# SQL query to extract patient data
-if INCREMENTAL_MODE:
-    sql_query = f"""
-    (
-        SELECT
-            patient_id,
+# Shared JDBC options for every Synapse read
+# fetchsize: the SQL Server driver otherwise returns 10 rows per round trip
+jdbc_options = {
+    "url": jdbc_url,
+    "user": SYNAPSE_USER,
+    "password": SYNAPSE_PASSWORD,
+    "driver": "com.microsoft.sqlserver.jdbc.SQLServerDriver",
+    "fetchsize": "5000",
+    "queryTimeout": "600",
+    "sessionInitStatement": "SET ARITHABORT ON; SET NOCOUNT ON;"
+}
+
+# Columns extracted from healthcare_fhir.patients, already renamed to Neo4j property
+# names and with the address concatenated server-side, so Spark receives final shapes
+patient_columns = f"""
+            patient_id AS id,
             mrn,
-            first_name,
-            last_name,
-            date_of_birth,
+            first_name AS firstName,
+            last_name AS lastName,
+            date_of_birth AS dateOfBirth,
             gender,
-            phone_number,
+            phone_number AS phoneNumber,
             email,
-            address_line1,
-            address_line2,
+            CONCAT_WS(', ', address_line1, address_line2, city, state, zip_code) AS address,
             city,
             state,
-            zip_code,
-            insurance_provider,
-            insurance_plan_id,
-            insurance_member_id,
-            plan_type,
-            policy_text,
-            clinical_narrative,
-            risk_score,
-            chronic_conditions_count,
-            active_medications_count,
-            last_visit_date,
-            next_appointment_date,
-            primary_care_provider_id,
-            care_coordinator_id,
-            preferred_language,
-            communication_preference,
-            hipaa_consent,
-            last_modified,
-            created_at
+            zip_code AS zipCode,
+            insurance_provider AS insuranceProvider,
+            insurance_plan_id AS insurancePlanId,
+            insurance_member_id AS insuranceMemberId,
+            plan_type AS planType,
+            policy_text AS policyText,
+            clinical_narrative AS clinicalNarrative,
+            risk_score AS riskScore,
+            chronic_conditions_count AS chronicConditionsCount,
+            active_medications_count AS activeMedicationsCount,
+            last_visit_date AS lastVisitDate,
+            next_appointment_date AS nextAppointmentDate,
+            primary_care_provider_id AS primaryCareProviderId,
+            care_coordinator_id AS careCoordinatorId,
+            preferred_language AS preferredLanguage,
+            communication_preference AS communicationPreference,
+            hipaa_consent AS hipaaConsent,
+            last_modified AS lastModified,
+            created_at AS createdAt,
+            (CHECKSUM(patient_id) & 0x7FFFFFFF) % {JDBC_NUM_PARTITIONS} AS partition_bucket"""
+
+def parse_last_run_timestamp(value):
+    """
+    Parse LAST_RUN_TIMESTAMP: "YYYY-MM-DD HH:MM:SS", the orchestrator's isoformat()
+    or an ISO 8601 pipeline parameter (fractions of any length, trailing Z or offset)
+    Returns: naive datetime in UTC
+    """
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    # fromisoformat only accepts 3 or 6 fractional digits before Python 3.11
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), value)
+
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+# SQL query to extract patient data
+if INCREMENTAL_MODE:
+    # Validate the timestamp and bind it once through prepareQuery rather than
+    # interpolating it into each predicate (prepareQuery needs Spark 3.4+)
+    last_run = parse_last_run_timestamp(LAST_RUN_TIMESTAMP)
+    prepare_query = f"DECLARE @last_run DATETIME2(6) = '{last_run:%Y-%m-%d %H:%M:%S.%f}';"
+
+    # UNION ALL of two single-column ranges instead of an OR, so each leg can use
+    # its own index; the second leg excludes rows the first already returned
+    sql_query = f"""
+    (
+        SELECT {patient_columns}
+        FROM healthcare_fhir.patients
+        WHERE last_modified > @last_run
+        UNION ALL
+        SELECT {patient_columns}
         FROM healthcare_fhir.patients
-        WHERE last_modified > '{LAST_RUN_TIMESTAMP}'
-        OR created_at > '{LAST_RUN_TIMESTAMP}'
+        WHERE created_at > @last_run
+        AND (last_modified <= @last_run OR last_modified IS NULL)
     ) AS patients_incremental
     """
 else:
-    sql_query = """
+    prepare_query = ""
+    sql_query = f"""
     (
-        SELECT
-            patient_id,
-            mrn,
-            first_name,
-            last_name,
-            date_of_birth,
-            gender,
-            phone_number,
-            email,
-            address_line1,
-            address_line2,
-            city,
-            state,
-            zip_code,
-            insurance_provider,
-            insurance_plan_id,
-            insurance_member_id,
-            plan_type,
-            policy_text,
-            clinical_narrative,
-            risk_score,
-            chronic_conditions_count,
-            active_medications_count,
-            last_visit_date,
-            next_appointment_date,
-            primary_care_provider_id,
-            care_coordinator_id,
-            preferred_language,
-            communication_preference,
-            hipaa_consent,
-            last_modified,
-            created_at
+        SELECT {patient_columns}
         FROM healthcare_fhir.patients
     ) AS patients_full
     """
 
-# Read data from Synapse
-patients_df = spark.read \
+# Probe the row count first: an empty delta skips the extract, embeddings and
+# Neo4j write entirely, and small deltas use fewer JDBC connections
+delta_count = spark.read \
     .format("jdbc") \
-    .option("url", jdbc_url) \
-    .option("dbtable", sql_query) \
-    .option("user", SYNAPSE_USER) \
-    .option("password", SYNAPSE_PASSWORD) \
-    .option("driver", "com.microsoft.sqlserver.jdbc.SQLServerDriver") \
-    .load()
+    .options(**jdbc_options) \
+    .option("prepareQuery", prepare_query) \
+    .option("dbtable", f"(SELECT COUNT_BIG(*) AS delta_count FROM {sql_query}) AS delta_probe") \
+    .load() \
+    .collect()[0]["delta_count"]
+
+if delta_count == 0:
+    print(f"✅ No patients changed since {LAST_RUN_TIMESTAMP}, skipping load")
+    dbutils.notebook.exit(json.dumps({"status": "success", "records": 0, "skipped": True}))
+
+# Conditional rather than min(): the pyspark.sql.functions import shadows the builtin
+# (delta_count > 0 here, so this is at least 1)
+read_partitions = math.ceil(delta_count / JDBC_ROWS_PER_PARTITION)
+read_partitions = JDBC_NUM_PARTITIONS if read_partitions > JDBC_NUM_PARTITIONS else read_partitions
+
+def execute_synapse_statement(statement):
+    """
+    Execute a single statement (e.g. DDL) against Synapse from the driver
+    Spark's JDBC source only runs queries, so this uses a plain JDBC connection
+    """
+    jvm = spark.sparkContext._gateway.jvm
+    connection = jvm.java.sql.DriverManager.getConnection(jdbc_url, SYNAPSE_USER, SYNAPSE_PASSWORD)
+    try:
+        connection.createStatement().execute(statement)
+    finally:
+        connection.close()
 
-print(f"✅ Extracted {patients_df.count()} patients from Synapse")
-patients_df.printSchema()
-patients_df.show(5, truncate=False)
+# Read data from Synapse
+staging_path = None
+
+def remove_staging_export():
+    """
+    Delete the full-refresh Parquet export, if any
+    The export holds PHI, so every cell that reads it removes it on failure
+    """
+    global staging_path
+    if staging_path:
+        dbutils.fs.rm(staging_path, recurse=True)
+        staging_path = None
+
+if INCREMENTAL_MODE:
+    # Small deltas: partitioned JDBC read
+    # patient_id is a string key, so partition on a hash bucket of it: bounds are known
+    # up front and each of the read_partitions connections pulls a range of buckets
+    patients_df = spark.read \
+        .format("jdbc") \
+        .options(**jdbc_options) \
+        .option("prepareQuery", prepare_query) \
+        .option("dbtable", sql_query) \
+        .option("partitionColumn", "partition_bucket") \
+        .option("lowerBound", 0) \
+        .option("upperBound", JDBC_NUM_PARTITIONS) \
+        .option("numPartitions", read_partitions) \
+        .option("pushDownPredicate", "true") \
+        .load() \
+        .drop("partition_bucket")
+else:
+    # Full refresh: have Synapse export the table to Parquet with CETAS and read the
+    # files in parallel, instead of streaming every row through JDBC
+    staging_run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    staging_table = f"healthcare_fhir.patients_export_{staging_run_id}"
+    staging_location = f"patients/{staging_run_id}/"
+    staging_path = f"{SYNAPSE_STAGING_PATH}/{staging_location}"
+
+    try:
+        execute_synapse_statement(f"""
+            CREATE EXTERNAL TABLE {staging_table}
+            WITH (
+                LOCATION = '{staging_location}',
+                DATA_SOURCE = {SYNAPSE_STAGING_DATA_SOURCE},
+                FILE_FORMAT = {SYNAPSE_STAGING_FILE_FORMAT}
+            )
+            AS SELECT {patient_columns}
+            FROM healthcare_fhir.patients
+        """)
+        # Dropping the external table removes only its metadata; the Parquet files stay
+        execute_synapse_statement(f"DROP EXTERNAL TABLE {staging_table}")
+
+        patients_df = spark.read.parquet(staging_path).drop("partition_bucket")
+    except Exception:
+        remove_staging_export()
+        raise
+
+if DEBUG:
+    patients_df.printSchema()
+    patients_df.show(5, truncate=False)
 
 # COMMAND ----------
 
@@ -169,53 +289,211 @@ patients_df.show(5, truncate=False)
 
 # COMMAND ----------
 
-def generate_embedding(text):
+# Arrow transport for the embedding pandas_udf: each Arrow batch holds exactly enough
+# texts to keep every in-flight request slot busy
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", BATCH_SIZE * EMBEDDING_CONCURRENCY)
+
+# Reuse pooled keep-alive HTTPS connections instead of a new TLS handshake per call,
+# retrying throttled (429) and transient 5xx responses with exponential backoff;
+# Azure OpenAI's Retry-After header on 429/503 takes precedence over the backoff
+embedding_session = requests.Session()
+embedding_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=6,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+))
+
+# Azure OpenAI settings shipped to executors once instead of in every task closure
+openai_config = spark.sparkContext.broadcast({
+    "endpoint": AZURE_OPENAI_ENDPOINT,
+    "key": AZURE_OPENAI_KEY,
+    "deployment": AZURE_OPENAI_DEPLOYMENT,
+    "api_version": AZURE_OPENAI_API_VERSION
+})
+
+def post_embedding_batch(inputs):
     """
-    Generate text embedding using Azure OpenAI text-embedding-3-small
-    Returns: List of 1536 floats
+    Request embeddings for a list of texts in a single Azure OpenAI call
+    A rejected (400) request is split in half and retried, so one bad input
+    does not cost the embeddings of the rest
+    Returns: List of 1536-float lists in input order, None for inputs that failed
     """
-    if not text or text.strip() == "":
-        return [0.0] * 1536  # Return zero vector for empty text
-
-    url = f"{AZURE_OPENAI_ENDPOINT}openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/embeddings?api-version={AZURE_OPENAI_API_VERSION}"
+    config = openai_config.value
+    url = f"{config['endpoint']}openai/deployments/{config['deployment']}/embeddings?api-version={config['api_version']}"
 
     headers = {
         "Content-Type": "application/json",
-        "api-key": AZURE_OPENAI_KEY
+        "api-key": config["key"]
     }
 
     payload = {
-        "input": text[:8000],  # Truncate to 8000 chars to stay within token limits
+        "input": inputs,
         "encoding_format": "float"
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = embedding_session.post(url, headers=headers, json=payload, timeout=(10, 60))
+        if response.status_code == 400 and len(inputs) > 1:
+            middle = len(inputs) // 2
+            return post_embedding_batch(inputs[:middle]) + post_embedding_batch(inputs[middle:])
         response.raise_for_status()
-        embedding = response.json()["data"][0]["embedding"]
-        return embedding
+        embeddings = [None] * len(inputs)
+        for item in response.json()["data"]:
+            embeddings[item["index"]] = item["embedding"]
+        return embeddings
     except Exception as e:
         print(f"⚠️ Embedding generation failed: {str(e)}")
-        return [0.0] * 1536  # Return zero vector on error
+        return [None] * len(inputs)
+
+def chunk_requests(texts):
+    """
+    Group the non-empty texts into embeddings requests capped at BATCH_SIZE
+    texts and MAX_CHARS_PER_REQUEST characters
+    Returns: List of chunks, each a list of positions in texts
+    """
+    chunks, chunk, chunk_chars = [], [], 0
+    for i, text in enumerate(texts):
+        if text.strip() == "":
+            continue
+        if chunk and (len(chunk) == BATCH_SIZE or chunk_chars + len(text) > MAX_CHARS_PER_REQUEST):
+            chunks.append(chunk)
+            chunk, chunk_chars = [], 0
+        chunk.append(i)
+        chunk_chars += len(text)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+@pandas_udf(ArrayType(FloatType()))
+def embed_batch(texts: pd.Series) -> pd.Series:
+    """
+    Generate text embeddings using Azure OpenAI text-embedding-3-small
+    Sends one request per chunk_requests chunk, keeping up to EMBEDDING_CONCURRENCY
+    requests in flight so network latency overlaps instead of adding up
+    Returns: Series of 1536-float lists (zero vector for empty text, null on failure)
+    """
+    # Truncate to 8000 chars to stay within token limits
+    texts = texts.fillna("").str.slice(0, 8000)
+    embeddings = [np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32) for _ in range(len(texts))]
+    chunks = chunk_requests(texts)
+
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        responses = executor.map(
+            lambda chunk: post_embedding_batch([texts.iat[i] for i in chunk]),
+            chunks
+        )
+        for chunk, chunk_embeddings in zip(chunks, responses):
+            # float32 arrays go to Arrow as contiguous buffers instead of lists of Python floats
+            # Null (not a zero vector) so failures show up as invalid embeddings
+            for i, embedding in zip(chunk, chunk_embeddings):
+                embeddings[i] = np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+
+    return pd.Series(embeddings)
+
+# Delta table of previously generated embeddings keyed on (text_sha256, model),
+# so unchanged text is never re-embedded and a new deployment starts a fresh cache
+embedding_cache_schema = StructType([
+    StructField("text_sha256", StringType(), False),
+    StructField("model", StringType(), False),
+    StructField("embedding", ArrayType(FloatType()), True),
+    StructField("created_at", TimestampType(), True)
+])
+
+# New cache entries, appended once the embeddings have been materialized
+embedding_cache_updates = []
+
+# Cached text -> embedding lookups, unpersisted in the cleanup cell
+cached_lookups = []
+
+def load_embedding_cache():
+    """
+    Read cached embeddings for the current deployment
+    Returns: DataFrame of (text_sha256, embedding); empty before the first run
+    """
+    try:
+        cache_df = spark.read.format("delta").load(EMBEDDING_CACHE_PATH)
+    except AnalysisException:
+        cache_df = spark.createDataFrame([], embedding_cache_schema)
+
+    return cache_df \
+        .where(col("model") == AZURE_OPENAI_DEPLOYMENT) \
+        .select("text_sha256", "embedding") \
+        .dropDuplicates(["text_sha256"])
 
-# Register UDF for embedding generation
-generate_embedding_udf = udf(generate_embedding, ArrayType(FloatType()))
+def embed_distinct(df, text_col, embedding_col, broadcast_join=True):
+    """
+    Embed each distinct non-empty value of text_col once and join it back onto df
+    Patients share boilerplate policy text, so this is far fewer API calls than one per row
+    Texts already in the embedding cache are not sent to Azure OpenAI again
+    Set broadcast_join=False for mostly-unique text that is too large to broadcast
+    Returns: df with embedding_col added (zero vector for null or blank text)
+    """
+    # Whitespace-only text is empty too: it gets the zero vector here and never
+    # reaches the embedding call or the cache
+    is_empty = col(text_col).isNull() | (length(trim(col(text_col))) == 0)
+
+    distinct_texts = df.select(text_col) \
+        .where(~is_empty) \
+        .distinct() \
+        .withColumn("text_sha256", sha2(col(text_col), 256))
+
+    lookup = distinct_texts.join(load_embedding_cache(), "text_sha256", "left")
+
+    cache_hits = lookup.where(col("embedding").isNotNull()).withColumn("cache_hit", lit(True))
+
+    # Spread cache misses across all executor cores so embedding batches run concurrently
+    cache_misses = lookup.where(col("embedding").isNull()) \
+        .drop("embedding") \
+        .repartition(spark.sparkContext.defaultParallelism) \
+        .withColumn("embedding", embed_batch(col(text_col))) \
+        .withColumn("cache_hit", lit(False))
+
+    text_embeddings = cache_hits.unionByName(cache_misses).cache()
+    cached_lookups.append(text_embeddings)
+
+    # Failed requests (null) are left out so they are retried on the next run
+    embedding_cache_updates.append(
+        text_embeddings
+        .where(~col("cache_hit") & col("embedding").isNotNull())
+        .select(
+            "text_sha256",
+            lit(AZURE_OPENAI_DEPLOYMENT).alias("model"),
+            "embedding",
+            current_timestamp().alias("created_at")
+        )
+    )
+
+    text_embeddings = text_embeddings.select(text_col, col("embedding").alias(embedding_col))
+
+    if broadcast_join:
+        text_embeddings = broadcast(text_embeddings)
+
+    return df.join(text_embeddings, text_col, "left").withColumn(
+        embedding_col,
+        when(is_empty, array_repeat(lit(0.0).cast("float"), EMBEDDING_DIMENSIONS))
+        .otherwise(col(embedding_col))
+    )
 
 # Generate embeddings for policy_text (for semantic search)
 print("🔄 Generating embeddings for policy documents...")
 
-patients_with_embeddings = patients_df.withColumn(
-    "policy_text_embedding",
-    generate_embedding_udf(col("policy_text"))
-)
+patients_with_embeddings = embed_distinct(patients_df, "policyText", "policyTextEmbedding")
 
 # Generate embeddings for clinical_narrative if it exists
-patients_with_embeddings = patients_with_embeddings.withColumn(
-    "clinical_narrative_embedding",
-    generate_embedding_udf(col("clinical_narrative"))
+# Narratives are mostly unique per patient, so let Spark pick the join strategy
+patients_with_embeddings = embed_distinct(
+    patients_with_embeddings, "clinicalNarrative", "clinicalNarrativeEmbedding", broadcast_join=False
 )
 
-print(f"✅ Generated embeddings for {patients_with_embeddings.count()} patients")
+# Materialize once so the JDBC read and embedding calls are not repeated by later actions
+patients_with_embeddings = patients_with_embeddings.persist(StorageLevel.MEMORY_AND_DISK)
 
 # COMMAND ----------
 
@@ -224,71 +502,79 @@ print(f"✅ Generated embeddings for {patients_with_embeddings.count()} patients
 
 # COMMAND ----------
 
+def embedding_columns(property_name):
+    """
+    Neo4j columns for an embedding: int8 values plus a per-vector scale when
+    QUANTIZE_EMBEDDINGS is set, otherwise the float vector as-is
+    Cosine similarity is scale-invariant, so the vector index can use the int8
+    values directly; multiply by the scale to recover approximate floats
+    """
+    if not QUANTIZE_EMBEDDINGS:
+        return [col(property_name)]
+
+    scale = array_max(transform(col(property_name), lambda x: abs(x))) / 127
+    quantized = when(
+        scale > 0,
+        transform(col(property_name), lambda x: round(x / scale).cast("tinyint"))
+    ).otherwise(
+        transform(col(property_name), lambda x: lit(0).cast("tinyint"))
+    )
+
+    return [
+        quantized.alias(property_name),
+        scale.cast("float").alias(f"{property_name}Scale")
+    ]
+
 # Transform to Neo4j format
+# Renames and the address concatenation are pushed down into the Synapse query
+embedding_properties = ["policyTextEmbedding", "clinicalNarrativeEmbedding"]
+
 patients_neo4j = patients_with_embeddings.select(
-    # Primary identifiers
-    col("patient_id").alias("id"),
-    col("mrn"),
-
-    # Demographics
-    col("first_name").alias("firstName"),
-    col("last_name").alias("lastName"),
-    col("date_of_birth").alias("dateOfBirth"),
-    col("gender"),
-
-    # Contact information
-    col("phone_number").alias("phoneNumber"),
-    col("email"),
-    concat_ws(", ",
-              col("address_line1"),
-              col("address_line2"),
-              col("city"),
-              col("state"),
-              col("zip_code")).alias("address"),
-    col("city"),
-    col("state"),
-    col("zip_code").alias("zipCode"),
-
-    # Insurance information
-    col("insurance_provider").alias("insuranceProvider"),
-    col("insurance_plan_id").alias("insurancePlanId"),
-    col("insurance_member_id").alias("insuranceMemberId"),
-    col("plan_type").alias("planType"),
-
-    # Clinical text fields
-    col("policy_text").alias("policyText"),
-    col("clinical_narrative").alias("clinicalNarrative"),
+    # Patient properties as shaped by Synapse
+    *[col(c) for c in patients_with_embeddings.columns if c not in embedding_properties],
 
     # Embeddings for hybrid search
-    col("policy_text_embedding").alias("policyTextEmbedding"),
-    col("clinical_narrative_embedding").alias("clinicalNarrativeEmbedding"),
-
-    # Health metrics
-    col("risk_score").alias("riskScore"),
-    col("chronic_conditions_count").alias("chronicConditionsCount"),
-    col("active_medications_count").alias("activeMedicationsCount"),
-
-    # Care coordination
-    col("last_visit_date").alias("lastVisitDate"),
-    col("next_appointment_date").alias("nextAppointmentDate"),
-    col("primary_care_provider_id").alias("primaryCareProviderId"),
-    col("care_coordinator_id").alias("careCoordinatorId"),
-
-    # Preferences
-    col("preferred_language").alias("preferredLanguage"),
-    col("communication_preference").alias("communicationPreference"),
-    col("hipaa_consent").alias("hipaaConsent"),
+    *embedding_columns("policyTextEmbedding"),
+    *embedding_columns("clinicalNarrativeEmbedding"),
 
     # Metadata
-    lit(datetime.now().isoformat()).alias("extractedAt"),
-    lit("synapse_etl").alias("extractionSource"),
-    col("last_modified").alias("lastModified"),
-    col("created_at").alias("createdAt")
+    current_timestamp().alias("extractedAt"),
+    lit("synapse_etl").alias("extractionSource")
 )
 
-print(f"✅ Transformed {patients_neo4j.count()} patients for Neo4j")
-patients_neo4j.printSchema()
-patients_neo4j.show(5, truncate=False)
+try:
+    # Single pass over the persisted rows for every count used below: the run
+    # summary, the data quality report and the ETL metadata
+    quality_stats = patients_neo4j.agg(
+        count("*").alias("total_patients"),
+        sum(when(col("policyText").isNull() | (col("policyText") == ""), 1).otherwise(0)).alias("missing_policy_text"),
+        sum(when(col("insuranceProvider").isNull(), 1).otherwise(0)).alias("missing_insurance"),
+        sum(when(col("riskScore").isNull(), 1).otherwise(0)).alias("missing_risk_score"),
+        sum(when(size(col("policyTextEmbedding")) != EMBEDDING_DIMENSIONS, 1).otherwise(0)).alias("invalid_embeddings"),
+        sum(when(size(col("policyTextEmbedding")) == EMBEDDING_DIMENSIONS, 1).otherwise(0)).alias("embeddings_generated"),
+        avg("riskScore").alias("avg_risk_score"),
+        max("riskScore").alias("max_risk_score"),
+        min("riskScore").alias("min_risk_score")
+    ).collect()[0]
+
+    # Record newly generated embeddings; they are read from the materialized cache,
+    # so this does not call Azure OpenAI again
+    for cache_update in embedding_cache_updates:
+        cache_update.write.format("delta").mode("append").save(EMBEDDING_CACHE_PATH)
+except Exception:
+    remove_staging_export()
+    raise
+
+records_extracted = quality_stats["total_patients"]
+embeddings_generated = quality_stats["embeddings_generated"]
+
+print(f"✅ Extracted {records_extracted} patients from Synapse")
+print(f"✅ Generated embeddings for {embeddings_generated} patients")
+print(f"✅ Transformed {records_extracted} patients for Neo4j")
+
+if DEBUG:
+    patients_neo4j.printSchema()
+    patients_neo4j.show(5, truncate=False)
 
 # COMMAND ----------
 
@@ -307,15 +593,24 @@ neo4j_options = {
 }
 
 # Write Patient nodes to Neo4j using MERGE (upsert)
-patients_neo4j.write \
-    .format("org.neo4j.spark.DataSource") \
-    .mode("Overwrite") \
-    .options(**neo4j_options) \
-    .option("labels", ":Patient") \
-    .option("node.keys", "id,mrn") \
-    .save()
-
-print(f"✅ Loaded {patients_neo4j.count()} Patient nodes into Neo4j")
+# With node.keys the connector's Overwrite mode issues MERGE on the keys and only
+# touches the rows in this DataFrame (the delta in incremental mode); Append would
+# CREATE duplicates. Partitioning by id keeps each key in a single writer.
+# This is the last read of the full-refresh export, so it is removed here either way
+try:
+    patients_neo4j.repartition(NEO4J_WRITE_PARTITIONS, "id").write \
+        .format("org.neo4j.spark.DataSource") \
+        .mode("Overwrite") \
+        .options(**neo4j_options) \
+        .option("labels", ":Patient") \
+        .option("node.keys", "id,mrn") \
+        .option("batch.size", 5000) \
+        .option("transaction.retries", 3) \
+        .save()
+finally:
+    remove_staging_export()
+
+print(f"✅ Loaded {records_extracted} Patient nodes into Neo4j")
 
 # COMMAND ----------
 
@@ -349,20 +644,10 @@ verification_df.show(truncate=False)
 
 # COMMAND ----------
 
-# Check for patients with missing critical data
-quality_checks = patients_neo4j.select(
-    count("*").alias("total_patients"),
-    sum(when(col("policyText").isNull() | (col("policyText") == ""), 1).otherwise(0)).alias("missing_policy_text"),
-    sum(when(col("insuranceProvider").isNull(), 1).otherwise(0)).alias("missing_insurance"),
-    sum(when(col("riskScore").isNull(), 1).otherwise(0)).alias("missing_risk_score"),
-    sum(when(size(col("policyTextEmbedding")) != 1536, 1).otherwise(0)).alias("invalid_embeddings"),
-    avg("riskScore").alias("avg_risk_score"),
-    max("riskScore").alias("max_risk_score"),
-    min("riskScore").alias("min_risk_score")
-)
-
+# Patients with missing critical data (aggregated in section 4)
 print("📊 Data Quality Report:")
-quality_checks.show(truncate=False)
+for metric, value in quality_stats.asDict().items():
+    print(f"   {metric}: {value}")
 
 # COMMAND ----------
 
@@ -377,9 +662,9 @@ etl_metadata = {
     "run_timestamp": datetime.now().isoformat(),
     "incremental_mode": INCREMENTAL_MODE,
     "last_run_timestamp": LAST_RUN_TIMESTAMP,
-    "records_extracted": patients_df.count(),
-    "records_loaded": patients_neo4j.count(),
-    "embeddings_generated": patients_with_embeddings.filter(size(col("policy_text_embedding")) == 1536).count(),
+    "records_extracted": records_extracted,
+    "records_loaded": records_extracted,
+    "embeddings_generated": embeddings_generated,
     "source_system": "synapse_fhir",
     "target_system": "neo4j_auradb",
     "status": "success"
@@ -400,9 +685,9 @@ print(json.dumps(etl_metadata, indent=2))
 # COMMAND ----------
 
 # Cache cleanup
-patients_df.unpersist()
 patients_with_embeddings.unpersist()
-patients_neo4j.unpersist()
+for cached_lookup in cached_lookups:
+    cached_lookup.unpersist()
 
 print("✅ Patients ETL pipeline completed successfully!")
 print(f"   - Extracted: {etl_metadata['records_extracted']} patients")
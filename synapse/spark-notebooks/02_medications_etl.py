@@ -21,12 +21,31 @@
 
 # COMMAND ----------
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
+from pyspark.sql.functions import pandas_udf
+from pyspark.sql.utils import AnalysisException
+from delta.tables import DeltaTable
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import numpy as np
+import pandas as pd
 import requests
 import json
-from datetime import datetime
+import re
+from datetime import datetime, timezone
+
+# SynapseML runs the embedding HTTP calls on the JVM when the library is installed on the pool
+try:
+    from synapse.ml.services.openai import OpenAIEmbedding
+    from pyspark.ml.functions import vector_to_array
+    SYNAPSEML_AVAILABLE = True
+except ImportError:
+    SYNAPSEML_AVAILABLE = False
 
 # Neo4j connection configuration
 NEO4J_URI = "neo4j+s://xxxxxxxx.databases.neo4j.io"
@@ -36,6 +55,7 @@ NEO4J_DATABASE = "neo4j"
 
 # Azure OpenAI configuration
 AZURE_OPENAI_ENDPOINT = "https://arthur-health.openai.azure.com/"
+AZURE_OPENAI_SERVICE_NAME = "arthur-health"  # Resource name in AZURE_OPENAI_ENDPOINT
 AZURE_OPENAI_KEY = dbutils.secrets.get(scope="arthur-health", key="azure-openai-key")
 AZURE_OPENAI_DEPLOYMENT = "text-embedding-3-small"
 AZURE_OPENAI_API_VERSION = "2024-02-01"
@@ -46,9 +66,25 @@ SYNAPSE_DATABASE = "healthcare_fhir"
 SYNAPSE_USER = dbutils.secrets.get(scope="arthur-health", key="synapse-user")
 SYNAPSE_PASSWORD = dbutils.secrets.get(scope="arthur-health", key="synapse-password")
 
-# ETL configuration
-INCREMENTAL_MODE = True
-LAST_RUN_TIMESTAMP = "2025-01-01 00:00:00"
+# ETL configuration (widgets are set by the master orchestrator; defaults apply to manual runs)
+dbutils.widgets.text("INCREMENTAL_MODE", "True")  # Set to False for full refresh
+dbutils.widgets.text("LAST_RUN_TIMESTAMP", "2025-01-01 00:00:00")  # Last successful run time
+INCREMENTAL_MODE = dbutils.widgets.get("INCREMENTAL_MODE") == "True"
+LAST_RUN_TIMESTAMP = dbutils.widgets.get("LAST_RUN_TIMESTAMP")
+JDBC_NUM_PARTITIONS = 8  # Parallel JDBC connections for the Synapse extract
+NEO4J_WRITE_PARTITIONS = 8  # Concurrent Neo4j writer transactions (keep within AuraDB limits)
+BATCH_SIZE = 256  # Texts per Azure OpenAI embeddings request (API max 2048)
+MAX_CHARS_PER_REQUEST = 300000  # Characters per embeddings request (~75k tokens, under the per-request token cap)
+# In-flight embedding requests per Spark task (set by the master orchestrator)
+dbutils.widgets.text("EMBEDDING_CONCURRENCY", "8")
+EMBEDDING_CONCURRENCY = int(dbutils.widgets.get("EMBEDDING_CONCURRENCY"))
+EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-small
+# Separate from the patients cache: the texts never overlap and both notebooks run at once
+EMBEDDING_CACHE_PATH = "abfss://etl@arthurhealth.dfs.core.windows.net/embedding_cache_medications"  # Replace with your ADLS path
+QUANTIZE_EMBEDDINGS = True  # Store embeddings in Neo4j as int8 values plus a per-vector scale
+# Opt-in: SynapseML's OpenAIEmbedding sends one text per request, embed_batch sends BATCH_SIZE
+USE_SYNAPSEML = False  # Embed with SynapseML's OpenAIEmbedding (when installed) instead of the pandas_udf
+DEBUG = False  # Set to True to print schemas and sample rows (each is an extra Spark job)
 
 print("✅ Configuration loaded")
 
@@ -61,10 +97,20 @@ print("✅ Configuration loaded")
 
 jdbc_url = f"jdbc:sqlserver://{SYNAPSE_SERVER}:1433;database={SYNAPSE_DATABASE};encrypt=true;trustServerCertificate=false;hostNameInCertificate=*.sql.azuresynapse.net;loginTimeout=30;"
 
-if INCREMENTAL_MODE:
-    sql_query = f"""
-    (
-        SELECT
+# Shared JDBC options for every Synapse read
+# fetchsize: the SQL Server driver otherwise returns 10 rows per round trip
+jdbc_options = {
+    "url": jdbc_url,
+    "user": SYNAPSE_USER,
+    "password": SYNAPSE_PASSWORD,
+    "driver": "com.microsoft.sqlserver.jdbc.SQLServerDriver",
+    "fetchsize": "5000",
+    "queryTimeout": "600"
+}
+
+# Columns extracted from healthcare_fhir.medications
+# Costs are fixed-point currency, so Spark sums and averages them exactly
+medication_columns = f"""
             medication_id,
             rxnorm_code,
             generic_name,
@@ -78,60 +124,80 @@ if INCREMENTAL_MODE:
             interactions,
             requires_prior_auth,
             formulary_tier,
-            estimated_cost_30day,
-            estimated_cost_90day,
+            CAST(estimated_cost_30day AS DECIMAL(18, 2)) AS estimated_cost_30day,
+            CAST(estimated_cost_90day AS DECIMAL(18, 2)) AS estimated_cost_90day,
             therapeutic_category,
             controlled_substance_schedule,
             pregnancy_category,
             fda_approved_date,
             last_modified,
-            created_at
+            created_at,
+            (CHECKSUM(medication_id) & 0x7FFFFFFF) % {JDBC_NUM_PARTITIONS} AS partition_bucket"""
+
+def parse_last_run_timestamp(value):
+    """
+    Parse LAST_RUN_TIMESTAMP: "YYYY-MM-DD HH:MM:SS", the orchestrator's isoformat()
+    or an ISO 8601 pipeline parameter (fractions of any length, trailing Z or offset)
+    Returns: naive datetime in UTC
+    """
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    # fromisoformat only accepts 3 or 6 fractional digits before Python 3.11
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), value)
+
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+if INCREMENTAL_MODE:
+    # Validate the timestamp and bind it once through prepareQuery rather than
+    # interpolating it into each predicate (prepareQuery needs Spark 3.4+)
+    last_run = parse_last_run_timestamp(LAST_RUN_TIMESTAMP)
+    prepare_query = f"DECLARE @last_run DATETIME2(6) = '{last_run:%Y-%m-%d %H:%M:%S.%f}';"
+
+    # UNION ALL of two single-column ranges instead of an OR, so each leg can use
+    # its own index; the second leg excludes rows the first already returned
+    sql_query = f"""
+    (
+        SELECT {medication_columns}
         FROM healthcare_fhir.medications
-        WHERE last_modified > '{LAST_RUN_TIMESTAMP}'
-        OR created_at > '{LAST_RUN_TIMESTAMP}'
+        WHERE last_modified > @last_run
+        UNION ALL
+        SELECT {medication_columns}
+        FROM healthcare_fhir.medications
+        WHERE created_at > @last_run
+        AND (last_modified <= @last_run OR last_modified IS NULL)
     ) AS medications_incremental
     """
 else:
-    sql_query = """
+    prepare_query = ""
+    sql_query = f"""
     (
-        SELECT
-            medication_id,
-            rxnorm_code,
-            generic_name,
-            brand_name,
-            drug_class,
-            dosage_form,
-            strength,
-            instructions,
-            side_effects,
-            contraindications,
-            interactions,
-            requires_prior_auth,
-            formulary_tier,
-            estimated_cost_30day,
-            estimated_cost_90day,
-            therapeutic_category,
-            controlled_substance_schedule,
-            pregnancy_category,
-            fda_approved_date,
-            last_modified,
-            created_at
+        SELECT {medication_columns}
         FROM healthcare_fhir.medications
     ) AS medications_full
     """
 
+# medication_id is a string key, so partition on a hash bucket of it: each of the
+# JDBC_NUM_PARTITIONS connections pulls one bucket and bounds are known up front
 medications_df = spark.read \
     .format("jdbc") \
-    .option("url", jdbc_url) \
+    .options(**jdbc_options) \
+    .option("prepareQuery", prepare_query) \
     .option("dbtable", sql_query) \
-    .option("user", SYNAPSE_USER) \
-    .option("password", SYNAPSE_PASSWORD) \
-    .option("driver", "com.microsoft.sqlserver.jdbc.SQLServerDriver") \
-    .load()
-
-print(f"✅ Extracted {medications_df.count()} medications from Synapse")
-medications_df.printSchema()
-medications_df.show(5, truncate=False)
+    .option("partitionColumn", "partition_bucket") \
+    .option("lowerBound", 0) \
+    .option("upperBound", JDBC_NUM_PARTITIONS) \
+    .option("numPartitions", JDBC_NUM_PARTITIONS) \
+    .option("pushDownPredicate", "true") \
+    .load() \
+    .drop("partition_bucket")
+
+if DEBUG:
+    medications_df.printSchema()
+    medications_df.show(5, truncate=False)
 
 # COMMAND ----------
 
@@ -140,49 +206,248 @@ medications_df.show(5, truncate=False)
 
 # COMMAND ----------
 
-def generate_embedding(text):
-    """Generate text embedding using Azure OpenAI"""
-    if not text or text.strip() == "":
-        return [0.0] * 1536
-
-    url = f"{AZURE_OPENAI_ENDPOINT}openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/embeddings?api-version={AZURE_OPENAI_API_VERSION}"
+# Arrow transport for the embedding pandas_udf: each Arrow batch holds exactly enough
+# texts to keep every in-flight request slot busy
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", BATCH_SIZE * EMBEDDING_CONCURRENCY)
+
+# Reuse pooled keep-alive HTTPS connections instead of a new TLS handshake per call,
+# retrying throttled (429) and transient 5xx responses with exponential backoff;
+# Azure OpenAI's Retry-After header on 429/503 takes precedence over the backoff
+embedding_session = requests.Session()
+embedding_session.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=6,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True
+    )
+))
+
+# Azure OpenAI settings shipped to executors once instead of in every task closure
+openai_config = spark.sparkContext.broadcast({
+    "endpoint": AZURE_OPENAI_ENDPOINT,
+    "key": AZURE_OPENAI_KEY,
+    "deployment": AZURE_OPENAI_DEPLOYMENT,
+    "api_version": AZURE_OPENAI_API_VERSION
+})
+
+def post_embedding_batch(inputs):
+    """
+    Request embeddings for a list of texts in a single Azure OpenAI call
+    A rejected (400) request is split in half and retried, so one bad input
+    does not cost the embeddings of the rest
+    Returns: List of 1536-float lists in input order, None for inputs that failed
+    """
+    config = openai_config.value
+    url = f"{config['endpoint']}openai/deployments/{config['deployment']}/embeddings?api-version={config['api_version']}"
 
     headers = {
         "Content-Type": "application/json",
-        "api-key": AZURE_OPENAI_KEY
+        "api-key": config["key"]
     }
 
     payload = {
-        "input": text[:8000],
+        "input": inputs,
         "encoding_format": "float"
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = embedding_session.post(url, headers=headers, json=payload, timeout=(10, 60))
+        if response.status_code == 400 and len(inputs) > 1:
+            middle = len(inputs) // 2
+            return post_embedding_batch(inputs[:middle]) + post_embedding_batch(inputs[middle:])
         response.raise_for_status()
-        embedding = response.json()["data"][0]["embedding"]
-        return embedding
+        embeddings = [None] * len(inputs)
+        for item in response.json()["data"]:
+            embeddings[item["index"]] = item["embedding"]
+        return embeddings
     except Exception as e:
         print(f"⚠️ Embedding generation failed: {str(e)}")
-        return [0.0] * 1536
+        return [None] * len(inputs)
 
-generate_embedding_udf = udf(generate_embedding, ArrayType(FloatType()))
+def chunk_requests(texts):
+    """
+    Group the non-empty texts into embeddings requests capped at BATCH_SIZE
+    texts and MAX_CHARS_PER_REQUEST characters
+    Returns: List of chunks, each a list of positions in texts
+    """
+    chunks, chunk, chunk_chars = [], [], 0
+    for i, text in enumerate(texts):
+        if text.strip() == "":
+            continue
+        if chunk and (len(chunk) == BATCH_SIZE or chunk_chars + len(text) > MAX_CHARS_PER_REQUEST):
+            chunks.append(chunk)
+            chunk, chunk_chars = [], 0
+        chunk.append(i)
+        chunk_chars += len(text)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+@pandas_udf(ArrayType(FloatType()))
+def embed_batch(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+    """
+    Generate text embeddings using Azure OpenAI text-embedding-3-small
+    Sends one request per chunk_requests chunk, keeping up to EMBEDDING_CONCURRENCY
+    requests in flight; the thread pool is shared by every Arrow batch in the task
+    Returns: Series of 1536-float lists (zero vector for empty text, null on failure)
+    """
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        for texts in batches:
+            # Truncate to 8000 chars to stay within token limits
+            texts = texts.fillna("").str.slice(0, 8000)
+            embeddings = [np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32) for _ in range(len(texts))]
+            chunks = chunk_requests(texts)
+
+            responses = executor.map(
+                lambda chunk: post_embedding_batch([texts.iat[i] for i in chunk]),
+                chunks
+            )
+            for chunk, chunk_embeddings in zip(chunks, responses):
+                # float32 arrays go to Arrow as contiguous buffers instead of lists of Python floats
+                # Null (not a zero vector) so failures show up as invalid embeddings
+                for i, embedding in zip(chunk, chunk_embeddings):
+                    embeddings[i] = np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+
+            yield pd.Series(embeddings)
+
+def add_embeddings(df, text_col):
+    """
+    Add an "embedding" column for the non-empty text in text_col
+    Uses SynapseML's OpenAIEmbedding transformer when available, otherwise embed_batch
+    Returns: df with embedding (1536 floats, null if the request failed)
+    """
+    if not (USE_SYNAPSEML and SYNAPSEML_AVAILABLE):
+        return df.withColumn("embedding", embed_batch(col(text_col)))
+
+    # Failed rows get a null output plus an error column, matching embed_batch
+    embedder = OpenAIEmbedding() \
+        .setSubscriptionKey(AZURE_OPENAI_KEY) \
+        .setCustomServiceName(AZURE_OPENAI_SERVICE_NAME) \
+        .setDeploymentName(AZURE_OPENAI_DEPLOYMENT) \
+        .setTextCol("embedding_input") \
+        .setOutputCol("embedding_vector") \
+        .setErrorCol("embedding_error") \
+        .setConcurrency(EMBEDDING_CONCURRENCY)
+
+    # Truncate to 8000 chars to stay within token limits
+    return embedder.transform(df.withColumn("embedding_input", substring(col(text_col), 1, 8000))) \
+        .withColumn("embedding", vector_to_array(col("embedding_vector"), "float32")) \
+        .drop("embedding_input", "embedding_vector", "embedding_error")
+
+# Delta table of previously generated embeddings keyed on (text_sha256, model),
+# so unchanged text is never re-embedded and a new deployment starts a fresh cache
+embedding_cache_schema = StructType([
+    StructField("text_sha256", StringType(), False),
+    StructField("model", StringType(), False),
+    StructField("embedding", ArrayType(FloatType()), True),
+    StructField("created_at", TimestampType(), True)
+])
+
+# New cache entries, merged in once the embeddings have been materialized
+embedding_cache_updates = []
+
+# Cached text -> embedding lookups, unpersisted in the cleanup cell
+cached_lookups = []
+
+def load_embedding_cache():
+    """
+    Read cached embeddings for the current deployment
+    Returns: DataFrame of (text_sha256, embedding); empty before the first run
+    """
+    try:
+        cache_df = spark.read.format("delta").load(EMBEDDING_CACHE_PATH)
+    except AnalysisException:
+        cache_df = spark.createDataFrame([], embedding_cache_schema)
+
+    return cache_df \
+        .where(col("model") == AZURE_OPENAI_DEPLOYMENT) \
+        .select("text_sha256", "embedding")
+
+def save_embedding_cache(updates):
+    """
+    MERGE new (text_sha256, model) entries into the embedding cache, creating it on the first run
+    Insert-only, so a text embedded by an overlapping run is kept once
+    """
+    if not DeltaTable.isDeltaTable(spark, EMBEDDING_CACHE_PATH):
+        updates.write.format("delta").save(EMBEDDING_CACHE_PATH)
+        return
+
+    DeltaTable.forPath(spark, EMBEDDING_CACHE_PATH).alias("cache") \
+        .merge(
+            updates.alias("updates"),
+            "cache.text_sha256 = updates.text_sha256 AND cache.model = updates.model"
+        ) \
+        .whenNotMatchedInsertAll() \
+        .execute()
+
+def embed_distinct(df, text_col, embedding_col):
+    """
+    Embed each distinct non-empty value of text_col once and join it back onto df
+    Brand and generic rows of a drug share instruction and side effect text, so this
+    is far fewer API calls than one per row
+    Texts already in the embedding cache are not sent to Azure OpenAI again
+    Returns: df with embedding_col added (zero vector for null or blank text)
+    """
+    # Whitespace-only text is empty too: it gets the zero vector here and never
+    # reaches the embedding call or the cache
+    is_empty = col(text_col).isNull() | (length(trim(col(text_col))) == 0)
+
+    # Project the text column alone, so the other medication columns never enter the
+    # distinct shuffle or the embedding call; vectors are joined back on the text
+    distinct_texts = df.select(text_col) \
+        .where(~is_empty) \
+        .distinct() \
+        .withColumn("text_sha256", sha2(col(text_col), 256))
+
+    lookup = distinct_texts.join(load_embedding_cache(), "text_sha256", "left")
+
+    cache_hits = lookup.where(col("embedding").isNotNull()).withColumn("cache_hit", lit(True))
+
+    # Spread cache misses across all executor cores so embedding batches run concurrently
+    cache_misses = lookup.where(col("embedding").isNull()) \
+        .drop("embedding") \
+        .repartition(spark.sparkContext.defaultParallelism)
+
+    cache_misses = add_embeddings(cache_misses, text_col).withColumn("cache_hit", lit(False))
+
+    text_embeddings = cache_hits.unionByName(cache_misses).cache()
+    cached_lookups.append(text_embeddings)
+
+    # Failed requests (null) are left out so they are retried on the next run
+    embedding_cache_updates.append(
+        text_embeddings
+        .where(~col("cache_hit") & col("embedding").isNotNull())
+        .select(
+            "text_sha256",
+            lit(AZURE_OPENAI_DEPLOYMENT).alias("model"),
+            "embedding",
+            current_timestamp().alias("created_at")
+        )
+    )
+
+    text_embeddings = text_embeddings.select(text_col, col("embedding").alias(embedding_col))
+
+    return df.join(broadcast(text_embeddings), text_col, "left").withColumn(
+        embedding_col,
+        when(is_empty, array_repeat(lit(0.0).cast("float"), EMBEDDING_DIMENSIONS))
+        .otherwise(col(embedding_col))
+    )
 
 # Generate embeddings for instructions (for semantic search of medication guidance)
 print("🔄 Generating embeddings for medication instructions...")
 
-medications_with_embeddings = medications_df.withColumn(
-    "instructions_embedding",
-    generate_embedding_udf(col("instructions"))
-)
+medications_with_embeddings = embed_distinct(medications_df, "instructions", "instructions_embedding")
 
 # Also embed side effects for semantic search
-medications_with_embeddings = medications_with_embeddings.withColumn(
-    "side_effects_embedding",
-    generate_embedding_udf(col("side_effects"))
-)
+medications_with_embeddings = embed_distinct(medications_with_embeddings, "side_effects", "side_effects_embedding")
 
-print(f"✅ Generated embeddings for {medications_with_embeddings.count()} medications")
+# Materialize once so the JDBC read and embedding calls are not repeated by later actions
+medications_with_embeddings = medications_with_embeddings.persist(StorageLevel.MEMORY_AND_DISK)
 
 # COMMAND ----------
 
@@ -191,6 +456,29 @@ print(f"✅ Generated embeddings for {medications_with_embeddings.count()} medic
 
 # COMMAND ----------
 
+def embedding_columns(embedding_col, property_name):
+    """
+    Neo4j columns for an embedding: int8 values plus a per-vector scale when
+    QUANTIZE_EMBEDDINGS is set, otherwise the float vector as-is
+    Cosine similarity is scale-invariant, so the vector index can use the int8
+    values directly; multiply by the scale to recover approximate floats
+    """
+    if not QUANTIZE_EMBEDDINGS:
+        return [col(embedding_col).alias(property_name)]
+
+    scale = array_max(transform(col(embedding_col), lambda x: abs(x))) / 127
+    quantized = when(
+        scale > 0,
+        transform(col(embedding_col), lambda x: round(x / scale).cast("tinyint"))
+    ).otherwise(
+        transform(col(embedding_col), lambda x: lit(0).cast("tinyint"))
+    )
+
+    return [
+        quantized.alias(property_name),
+        scale.cast("float").alias(f"{property_name}Scale")
+    ]
+
 medications_neo4j = medications_with_embeddings.select(
     # Primary identifiers
     col("medication_id").alias("id"),
@@ -210,8 +498,8 @@ medications_neo4j = medications_with_embeddings.select(
     col("interactions"),
 
     # Embeddings for hybrid search
-    col("instructions_embedding").alias("instructionsEmbedding"),
-    col("side_effects_embedding").alias("sideEffectsEmbedding"),
+    *embedding_columns("instructions_embedding", "instructionsEmbedding"),
+    *embedding_columns("side_effects_embedding", "sideEffectsEmbedding"),
 
     # Prior authorization and cost
     col("requires_prior_auth").alias("requiresPriorAuth"),
@@ -226,14 +514,39 @@ medications_neo4j = medications_with_embeddings.select(
     col("fda_approved_date").alias("fdaApprovedDate"),
 
     # Metadata
-    lit(datetime.now().isoformat()).alias("extractedAt"),
+    current_timestamp().alias("extractedAt"),
     lit("synapse_etl").alias("extractionSource"),
     col("last_modified").alias("lastModified"),
     col("created_at").alias("createdAt")
 )
 
-print(f"✅ Transformed {medications_neo4j.count()} medications for Neo4j")
-medications_neo4j.printSchema()
+# Single pass over the persisted rows for every count used below: the run
+# summary, the data quality report and the ETL metadata
+quality_stats = medications_neo4j.agg(
+    count("*").alias("total_medications"),
+    sum(when(col("instructions").isNull() | (col("instructions") == ""), 1).otherwise(0)).alias("missing_instructions"),
+    sum(when(col("requiresPriorAuth") == True, 1).otherwise(0)).alias("requires_pa_count"),
+    sum(when(size(col("instructionsEmbedding")) != EMBEDDING_DIMENSIONS, 1).otherwise(0)).alias("invalid_embeddings"),
+    sum(when(size(col("instructionsEmbedding")) == EMBEDDING_DIMENSIONS, 1).otherwise(0)).alias("embeddings_generated"),
+    avg("estimatedCost30Day").alias("avg_cost_30day"),
+    max("estimatedCost30Day").alias("max_cost_30day")
+).collect()[0]
+
+records_extracted = quality_stats["total_medications"]
+embeddings_generated = quality_stats["embeddings_generated"]
+
+print(f"✅ Extracted {records_extracted} medications from Synapse")
+print(f"✅ Generated embeddings for {embeddings_generated} medications")
+print(f"✅ Transformed {records_extracted} medications for Neo4j")
+
+# Record newly generated embeddings; they are read from the materialized cache,
+# so this does not call Azure OpenAI again
+for cache_update in embedding_cache_updates:
+    save_embedding_cache(cache_update)
+
+if DEBUG:
+    medications_neo4j.printSchema()
+    medications_neo4j.show(5, truncate=False)
 
 # COMMAND ----------
 
@@ -250,15 +563,26 @@ neo4j_options = {
     "database": NEO4J_DATABASE
 }
 
-medications_neo4j.write \
+# Write Medication nodes to Neo4j using MERGE (upsert)
+# With node.keys the connector's Overwrite mode issues MERGE on the keys and only
+# touches the rows in this DataFrame (the delta in incremental mode); Append would
+# CREATE duplicates. Partitioning by id keeps each key in a single writer.
+# Neo4j has no decimal type (the connector would write strings), so costs go as floats
+medications_neo4j \
+    .withColumn("estimatedCost30Day", col("estimatedCost30Day").cast("double")) \
+    .withColumn("estimatedCost90Day", col("estimatedCost90Day").cast("double")) \
+    .repartition(NEO4J_WRITE_PARTITIONS, "id") \
+    .write \
     .format("org.neo4j.spark.DataSource") \
     .mode("Overwrite") \
     .options(**neo4j_options) \
     .option("labels", ":Medication") \
     .option("node.keys", "id,rxNormCode") \
+    .option("batch.size", 5000) \
+    .option("transaction.retries", 3) \
     .save()
 
-print(f"✅ Loaded {medications_neo4j.count()} Medication nodes into Neo4j")
+print(f"✅ Loaded {records_extracted} Medication nodes into Neo4j")
 
 # COMMAND ----------
 
@@ -291,17 +615,10 @@ verification_df.show(truncate=False)
 
 # COMMAND ----------
 
-quality_checks = medications_neo4j.select(
-    count("*").alias("total_medications"),
-    sum(when(col("instructions").isNull() | (col("instructions") == ""), 1).otherwise(0)).alias("missing_instructions"),
-    sum(when(col("requiresPriorAuth") == True, 1).otherwise(0)).alias("requires_pa_count"),
-    sum(when(size(col("instructionsEmbedding")) != 1536, 1).otherwise(0)).alias("invalid_embeddings"),
-    avg("estimatedCost30Day").alias("avg_cost_30day"),
-    max("estimatedCost30Day").alias("max_cost_30day")
-)
-
+# Aggregated in section 4
 print("📊 Data Quality Report:")
-quality_checks.show(truncate=False)
+for metric, value in quality_stats.asDict().items():
+    print(f"   {metric}: {value}")
 
 # COMMAND ----------
 
@@ -315,9 +632,9 @@ etl_metadata = {
     "run_timestamp": datetime.now().isoformat(),
     "incremental_mode": INCREMENTAL_MODE,
     "last_run_timestamp": LAST_RUN_TIMESTAMP,
-    "records_extracted": medications_df.count(),
-    "records_loaded": medications_neo4j.count(),
-    "embeddings_generated": medications_with_embeddings.filter(size(col("instructions_embedding")) == 1536).count(),
+    "records_extracted": records_extracted,
+    "records_loaded": records_extracted,
+    "embeddings_generated": embeddings_generated,
     "source_system": "synapse_fhir",
     "target_system": "neo4j_auradb",
     "status": "success"
@@ -328,6 +645,11 @@ print(json.dumps(etl_metadata, indent=2))
 
 # COMMAND ----------
 
+# Cache cleanup
+medications_with_embeddings.unpersist()
+for cached_lookup in cached_lookups:
+    cached_lookup.unpersist()
+
 print("✅ Medications ETL pipeline completed successfully!")
 print(f"   - Extracted: {etl_metadata['records_extracted']} medications")
 print(f"   - Loaded: {etl_metadata['records_loaded']} medications")